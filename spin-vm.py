@@ -1,14 +1,30 @@
 #!/usr/bin/env python3
 import os
+import re
 import sys
 import subprocess
-import shutil
+import signal
+import socket
+import json
+import tempfile
+import contextlib
+import functools
+import itertools
 
 # --- Constants ---
 QEMU_BIN = "qemu-system-x86_64"
 OVMF_CODE = "/usr/share/OVMF/OVMF_CODE_4M.fd"
 OVMF_VARS_TEMPLATE = "/usr/share/OVMF/OVMF_VARS_4M.fd"
 BACKTITLE = "SIMPLE VM CREATOR by Alexia Michelle https://github.com/alexiarstein/spin-vm"
+BROWSE_PAGE_SIZE = 200  # max entries per browse menu page
+# apt package -> binary it provides (None: firmware files), used when dpkg-query is unavailable
+DEPENDENCIES = {
+    "qemu-system-x86": "qemu-system-x86_64",
+    "qemu-utils": "qemu-img",
+    "dialog": "dialog",
+    "ovmf": None,
+}
+INSTALL_ONLY_FLAGS = frozenset({"-cdrom", "-boot"})  # dropped with their value when re-running after install
 
 def run_command(cmd, capture_output=False, shell=False):
     try:
@@ -22,84 +38,231 @@ def run_command(cmd, capture_output=False, shell=False):
         print(f"Error running command: {cmd}\n{e}")
         return False
 
+def entry_kind(entry):
+    # DirEntry.is_dir()/is_file() raise on symlink loops or unreadable targets; skip those
+    # entries like os.path.isdir/isfile did
+    try:
+        if entry.is_dir():
+            return "dir"
+        if entry.is_file():
+            return "file"
+    except OSError:
+        pass
+    return None
+
+def path_executables(names):
+    # One scandir per $PATH entry instead of a shutil.which() walk per binary
+    wanted = set(names)
+    available = set()
+    for d in os.environ.get("PATH", "").split(os.pathsep):
+        if not d:
+            continue
+        try:
+            with os.scandir(d) as it:
+                candidates = [e for e in it if e.name in wanted and e.name not in available]
+        except OSError:
+            continue
+        # Like shutil.which, only count files we may actually execute
+        for e in candidates:
+            if entry_kind(e) == "file" and os.access(e.path, os.X_OK):
+                available.add(e.name)
+    return available
+
+@contextlib.contextmanager
+def qemu_process(args):
+    proc = subprocess.Popen(args)
+    # Forward Ctrl-C to QEMU so it is shut down instead of left behind
+    previous = signal.signal(signal.SIGINT, lambda *_: proc.terminate())
+    try:
+        yield proc
+        proc.wait()
+    except BaseException:
+        # Don't leave QEMU running behind an error in the caller
+        proc.terminate()
+        proc.wait()
+        raise
+    finally:
+        signal.signal(signal.SIGINT, previous)
+
+def launch_qemu(args):
+    with qemu_process(args):
+        pass  # qemu_process waits for QEMU on exit
+
+def qmp_execute(sock_path, *commands):
+    # Drive a running QEMU through its QMP socket; False if it is gone or rejects a command
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(5)
+            sock.connect(sock_path)
+            with sock.makefile("rw") as stream:
+                stream.readline()  # greeting
+                for command in ({"execute": "qmp_capabilities"},) + commands:
+                    stream.write(json.dumps(command) + "\n")
+                    stream.flush()
+                    reply = {}
+                    while "return" not in reply and "error" not in reply:  # skip async events
+                        reply = json.loads(stream.readline())
+                    if "error" in reply:
+                        return False
+        return True
+    except (OSError, ValueError):
+        return False
+
+def filesystem_type(path):
+    # Longest mount point in /proc/mounts containing path wins
+    path = os.path.realpath(path)
+    best, fstype = "", None
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                fields = line.split()
+                # The kernel octal-escapes space, tab, newline and backslash (\040, \011, \012, \134)
+                mount_point = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), fields[1])
+                if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) and len(mount_point) > len(best):
+                    best, fstype = mount_point, fields[2]
+    except OSError:
+        return None
+    return fstype
+
+def missing_packages():
+    # One dpkg-query for every package instead of probing the filesystem per dependency
+    try:
+        result = subprocess.run(["dpkg-query", "-W", "-f=${Package}\t${Status}\n"] + list(DEPENDENCIES),
+                                capture_output=True, text=True)
+    except FileNotFoundError:
+        # Not a dpkg system; fall back to looking for the binaries (firmware is checked below)
+        available = path_executables(binary for binary in DEPENDENCIES.values() if binary)
+        missing = [pkg for pkg, binary in DEPENDENCIES.items() if binary and binary not in available]
+    else:
+        installed = {line.split("\t")[0] for line in result.stdout.splitlines() if line.endswith("install ok installed")}
+        missing = [pkg for pkg in DEPENDENCIES if pkg not in installed]
+
+    # Both firmware images are needed for UEFI; catch a missing template now rather than at copy time
+    if "ovmf" not in missing:
+        for firmware in (OVMF_CODE, OVMF_VARS_TEMPLATE):
+            try:
+                os.stat(firmware)
+            except OSError:
+                print(f"UEFI firmware not found: {firmware}")
+                missing.append("ovmf")
+                break
+    return missing
+
 def check_dependencies():
-    deps = ["qemu-system-x86_64", "qemu-img", "dialog"]
-    missing = [d for d in deps if shutil.which(d) is None]
-    
-    # Check for UEFI firmware if needed later, but basic ones first
-    if not os.path.exists(OVMF_CODE):
-        missing.append("ovmf")
+    missing = missing_packages()
 
     if missing:
         print(f"Missing dependencies: {', '.join(missing)}")
-        choice = input("Do you want to install them using apt? (y/n): ")
-        if choice.lower() == 'y':
-            packages = []
-            for m in missing:
-                if m == "ovmf": packages.append("ovmf")
-                elif m.startswith("qemu"): packages.append("qemu-system-x86")
-                else: packages.append(m)
-            
-            # Remove duplicates
-            packages = list(set(packages))
-            print(f"Installing: {packages}")
-            run_command(["sudo", "apt", "update"])
-            run_command(["sudo", "apt", "install", "-y"] + packages)
+        # Refresh package lists while the user answers; -n so sudo never competes for the prompt
+        try:
+            update = subprocess.Popen(["sudo", "-n", "apt", "update"], stdin=subprocess.DEVNULL,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError:
+            update = None  # e.g. no sudo; handled like a failed prefetch below
+        if "dialog" in missing:
+            # Can't use dialog to ask for dialog itself
+            install = input("Do you want to install them using apt? (y/n): ").lower() == 'y'
+        else:
+            install = dialog_yesno("Missing Dependencies", f"Missing dependencies: {', '.join(missing)}\n\nDo you want to install them using apt?")
+        if install:
+            print(f"Installing: {missing}")
+            if update is None or update.wait() != 0:
+                # Background refresh needed a password (or failed); run it interactively
+                run_command(["sudo", "apt", "update"])
+            run_command(["sudo", "apt", "install", "-y"] + missing)
         else:
+            if update is not None:
+                # The user declined; don't leave a root apt update running
+                update.terminate()
+                update.wait()
             print("Cannot proceed without dependencies.")
             sys.exit(1)
 
-def dialog_input(title, prompt, default=""):
-    cmd = ["dialog", "--backtitle", BACKTITLE, "--title", title, "--inputbox", prompt, "10", "60", default]
+def run_dialog(args):
+    # Spawn dialog directly and read its result from a stderr pipe, skipping subprocess' Popen machinery
+    r, w = os.pipe2(os.O_CLOEXEC)
+    try:
+        pid = os.posix_spawnp("dialog", ["dialog"] + args, os.environ, file_actions=[(os.POSIX_SPAWN_DUP2, w, 2)])
+    except OSError:
+        os.close(r)
+        raise
+    finally:
+        os.close(w)
     # Dialog outputs to stderr
-    result = subprocess.run(cmd, stderr=subprocess.PIPE, text=True)
-    if result.returncode == 0:
-        return result.stderr.strip()
+    with os.fdopen(r, "rb") as f:
+        output = f.read()
+    _, status = os.waitpid(pid, 0)
+    # Only drop the trailing newline: menu tags (file names) may start or end with spaces
+    # fsdecode so non-UTF-8 file names round-trip to the same str scandir returned
+    return os.waitstatus_to_exitcode(status), os.fsdecode(output).rstrip("\n")
+
+def dialog_input(title, prompt, default=""):
+    returncode, output = run_dialog(["--backtitle", BACKTITLE, "--title", title, "--inputbox", prompt, "10", "60", default])
+    if returncode == 0:
+        return output
     return None
 
 def dialog_fselect(title, path):
-    cmd = ["dialog", "--title", title, "--fselect", path, "15", "70"]
-    result = subprocess.run(cmd, stderr=subprocess.PIPE, text=True)
-    if result.returncode == 0:
-        return result.stderr.strip()
+    returncode, output = run_dialog(["--title", title, "--fselect", path, "15", "70"])
+    if returncode == 0:
+        return output
     return None
 
 def dialog_dselect(title, path):
-    cmd = ["dialog", "--title", title, "--dselect", path, "15", "70"]
-    result = subprocess.run(cmd, stderr=subprocess.PIPE, text=True)
-    if result.returncode == 0:
-        return result.stderr.strip()
+    returncode, output = run_dialog(["--title", title, "--dselect", path, "15", "70"])
+    if returncode == 0:
+        return output
     return None
 
 def dialog_menu(title, prompt, choices, height=15, width=60):
-    # choices is list of (tag, item)
-    flattened = []
-    for tag, item in choices:
-        flattened.extend([tag, item])
-    
-    cmd = ["dialog", "--backtitle", BACKTITLE, "--title", title, "--menu", prompt, str(height), str(width), str(len(choices))] + flattened
-    result = subprocess.run(cmd, stderr=subprocess.PIPE, text=True)
-    if result.returncode == 0:
-        return result.stderr.strip()
+    # choices is list of (tag, item); flatten in C rather than one extend() per pair
+    args = ["--backtitle", BACKTITLE, "--title", title, "--menu", prompt, str(height), str(width), str(len(choices))]
+    args.extend(itertools.chain.from_iterable(choices))
+    returncode, output = run_dialog(args)
+    if returncode == 0:
+        return output
     return None
 
 def dialog_yesno(title, prompt, yes_label="Yes", no_label="No"):
-    cmd = ["dialog", "--backtitle", BACKTITLE, "--title", title, "--yes-label", yes_label, "--no-label", no_label, "--yesno", prompt, "10", "60"]
-    result = subprocess.run(cmd)
-    return result.returncode == 0
+    returncode, _ = run_dialog(["--backtitle", BACKTITLE, "--title", title, "--yes-label", yes_label, "--no-label", no_label, "--yesno", prompt, "10", "60"])
+    return returncode == 0
+
+@functools.lru_cache(maxsize=512)
+def normalize_path(path):
+    # Browse sessions keep starting from the same few paths; normalize each only once
+    return os.path.abspath(os.path.expanduser(path))
+
+@functools.lru_cache(maxsize=512)
+def is_dir_cached(path):
+    # Start paths repeat across browse_path calls; nothing creates or removes them in between
+    return os.path.isdir(path)
 
 def browse_path(start_path, select_dir=False, title="Browse"):
-    current_path = os.path.abspath(start_path)
-    if not os.path.isdir(current_path):
-        current_path = os.path.expanduser("~")
+    current_path = normalize_path(start_path)
+    if not is_dir_cached(current_path):
+        current_path = normalize_path("~")
+
+    listing = None  # menu entries for current_path, scanned once per directory
+    page_index = 0
 
     while True:
-        try:
-            items = os.listdir(current_path)
-        except PermissionError:
-            dialog_yesno("Error", f"Permission denied: {current_path}")
-            current_path = os.path.dirname(current_path)
-            continue
+        if listing is None:
+            try:
+                with os.scandir(current_path) as it:
+                    entries = list(it)
+            except PermissionError:
+                dialog_yesno("Error", f"Permission denied: {current_path}")
+                current_path = os.path.dirname(current_path)
+                continue
+
+            # Sort directories first, then files (DirEntry reuses the dirent type, no extra stat)
+            kinds = [(entry_kind(e), e) for e in entries]
+            dirs = sorted((e for kind, e in kinds if kind == "dir"), key=lambda e: e.name)
+            files = sorted((e for kind, e in kinds if kind == "file"), key=lambda e: e.name)
+            listing = [(e.name + "/", "(Dir)") for e in dirs] + [(e.name, "(File)") for e in files]
+            # Menu tag -> full path, reusing the path scandir already built
+            paths = {tag: e.path for (tag, _), e in zip(listing, dirs + files)}
+            page_index = 0
 
         choices = []
         # Add special option for directory selection
@@ -107,17 +270,20 @@ def browse_path(start_path, select_dir=False, title="Browse"):
             choices.append((".", f"--> SELECT THIS DIRECTORY: {current_path} <--"))
         
         choices.append(("..", "../ (Go Up)"))
-        
-        # Sort directories first, then files
-        dirs = sorted([d for d in items if os.path.isdir(os.path.join(current_path, d))])
-        files = sorted([f for f in items if os.path.isfile(os.path.join(current_path, f))])
 
-        for d in dirs:
-            choices.append((d + "/", "(Dir)"))
-        for f in files:
-            choices.append((f, "(File)"))
+        # Only hand one page to dialog so huge directories stay responsive;
+        # page tags contain "/" so no file name can collide with them
+        page_count = max(1, -(-len(listing) // BROWSE_PAGE_SIZE))
+        if page_index > 0:
+            choices.append(("/prev", "[<< Previous page]"))
+        start = page_index * BROWSE_PAGE_SIZE
+        choices.extend(listing[start:start + BROWSE_PAGE_SIZE])
+        if page_index < page_count - 1:
+            choices.append(("/next", "[Next page >>]"))
 
         prompt = f"Current Path: {current_path}\nSelect a {'directory' if select_dir else 'file'}:"
+        if page_count > 1:
+            prompt += f" (page {page_index + 1}/{page_count})"
         selection = dialog_menu(title, prompt, choices, height=20, width=75)
 
         if selection is None: # Cancel
@@ -125,12 +291,21 @@ def browse_path(start_path, select_dir=False, title="Browse"):
         
         if selection == ".":
             return current_path
+        elif selection == "/next":
+            page_index += 1
+        elif selection == "/prev":
+            page_index -= 1
         elif selection == "..":
             current_path = os.path.dirname(current_path)
+            listing = None
+        elif selection not in paths:
+            # Unknown tag (shouldn't happen); show the menu again
+            continue
         elif selection.endswith("/"):
-            current_path = os.path.join(current_path, selection[:-1])
+            current_path = paths[selection]
+            listing = None
         else:
-            full_path = os.path.join(current_path, selection)
+            full_path = paths[selection]
             if select_dir:
                 # If they clicked a file while in dir seek mode, ignore or maybe prompt
                 continue
@@ -163,9 +338,11 @@ def main():
         sys.exit(1)
 
     # Setup Paths
-    disk_name = os.path.basename(iso_path).replace(".iso", "") + (".uefi" if is_uefi else "") + ".qcow2"
+    iso_name = os.path.basename(iso_path)
+    iso_stem = iso_name[:-len(".iso")] if iso_name.lower().endswith(".iso") else iso_name
+    disk_name = iso_stem + (".uefi" if is_uefi else "") + ".qcow2"
     disk_path = os.path.join(vm_dir, disk_name)
-    vars_path = os.path.join(vm_dir, "OVMF_VARS_" + os.path.basename(iso_path).replace(".iso", "") + ".fd")
+    vars_path = os.path.join(vm_dir, "OVMF_VARS_" + iso_stem + ".fd")
 
     # QEMU Args
     qemu_args = [
@@ -197,12 +374,23 @@ def main():
                 print("Aborting.")
                 sys.exit(1)
         
-        run_command(["qemu-img", "create", "-f", "qcow2", disk_path, "20G"])
+        # Extended L2 tables cut metadata lookups; on btrfs also disable CoW on the image to avoid fragmentation
+        disk_opts = ["nocow=on"] if filesystem_type(vm_dir) == "btrfs" else []
+        # extended_l2 needs QEMU 5.2+; try it quietly and fall back without it on older versions
+        cmd = ["qemu-img", "create", "-f", "qcow2", "-o", ",".join(disk_opts + ["extended_l2=on"]), disk_path, "20G"]
+        created = subprocess.run(cmd, stderr=subprocess.DEVNULL).returncode == 0
+        if not created:
+            cmd = ["qemu-img", "create", "-f", "qcow2"] + (["-o", ",".join(disk_opts)] if disk_opts else []) + [disk_path, "20G"]
+            created = run_command(cmd)
+        if not created:
+            print(f"Could not create disk: {disk_path}")
+            sys.exit(1)
 
         if is_uefi:
             if os.path.exists(vars_path):
                 os.remove(vars_path)
-            shutil.copy(OVMF_VARS_TEMPLATE, vars_path)
+            from shutil import copyfile  # only needed on this path
+            copyfile(OVMF_VARS_TEMPLATE, vars_path)
 
         qemu_args.extend(["-cdrom", iso_path, "-boot", "order=d"])
     
@@ -215,18 +403,45 @@ def main():
         qemu_args.extend(["-boot", "order=c"])
     
 
-    # Launch
-    print(f"Launching QEMU: {' '.join(qemu_args)}")
-    subprocess.run(qemu_args)
+    if mode == "install":
+        # Filter out install specific args (flag and value together) while we still have a moment
+        new_args = []
+        it = iter(qemu_args)
+        for arg in it:
+            if arg in INSTALL_ONLY_FLAGS:
+                next(it, None)
+                continue
+            new_args.append(arg)
+        new_args.extend(["-boot", "order=c"])
 
+    # Launch
     if mode == "install":
-        if dialog_yesno("Install Complete", "Installation process finished. Do you want to run the VM now from the virtual drive?"):
-            # Re-run in 'run' mode
+        # QMP lets us reboot the same QEMU from disk once the install is done. The socket lives in a
+        # private temp dir: AF_UNIX paths are limited to ~107 bytes and vm_dir may be long or contain commas
+        with tempfile.TemporaryDirectory(prefix="spin-vm-") as qmp_dir:
+            qmp_path = os.path.join(qmp_dir, "qmp.sock")
+            qemu_args.extend(["-qmp", f"unix:{qmp_path},server=on,wait=off"])
+            print(f"Launching QEMU: {' '.join(qemu_args)}")
+            with qemu_process(qemu_args) as proc:
+                reboot = dialog_yesno("Install", "The installer is running in the QEMU window.\n\n"
+                                      "When it has finished, select Yes to eject the ISO and boot the VM from the virtual drive. "
+                                      "No leaves the VM running until you close it.")
+                if reboot and proc.poll() is None:
+                    # QEMU is still up: eject the ISO (OVMF ignores boot order), switch boot order and
+                    # reset it instead of a second cold start
+                    print("Rebooting VM from the virtual drive...")
+                    reboot = not qmp_execute(qmp_path,
+                                             {"execute": "eject", "arguments": {"device": "ide1-cd0", "force": True}},
+                                             {"execute": "human-monitor-command", "arguments": {"command-line": "boot_set c"}},
+                                             {"execute": "system_reset"})
+
+        if reboot:
+            # QEMU already exited (or QMP failed): re-run in 'run' mode
             print("Restarting VM in RUN mode...")
-            # Filter out install specific args
-            new_args = [arg for arg in qemu_args if arg not in ["-cdrom", iso_path, "order=d", "-boot"]]
-            new_args.extend(["-boot", "order=c"])
-            subprocess.run(new_args)
+            launch_qemu(new_args)
+    else:
+        print(f"Launching QEMU: {' '.join(qemu_args)}")
+        launch_qemu(qemu_args)
 
 if __name__ == "__main__":
     main()